@@ -1,13 +1,15 @@
 from flask import Flask, request, jsonify, make_response
 from flask_sqlalchemy import SQLAlchemy
 from scipy.spatial.distance import euclidean
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, UniqueConstraint, case, cast, func, literal, select
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 from functools import wraps
-from emotion_analysis import preProcessEmotionModel
+from emotion_analysis import preProcessEmotionModel, class_names
 
 import uuid
 import jwt
+import hashlib
 import datetime
 import requests
 import numpy as np
@@ -84,21 +86,58 @@ class Emotion(db.Model):
     user_id = db.Column(db.Integer)
 
 
+# version counter of a user's todo / chat / emotion collection, used for the etags of the GET routes.
+# every route that adds, changes or deletes rows of a collection bumps it in the same transaction
+class CollectionVersion(db.Model):
+    table_name = db.Column(db.String(50), primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
 class Songs(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     song_name = db.Column(db.String(50), unique=True)
     song_link = db.Column(db.String(1000))
 
 
+# a user has at most one rating per song. rating the same song again updates it (see POST /rating)
 class Ratings(db.Model):
+    __table_args__ = (UniqueConstraint('song_id', 'user_id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     song_id = db.Column(db.Integer, ForeignKey('songs.id'))
     user_id = db.Column(db.Integer, ForeignKey('user.id'))
     ratings = db.Column(db.Integer)
 
 
-# class Name on Emotions
-class_names = ['joy', 'fear', 'anger', 'sadness', 'neutral']
+# aggregate of all ratings of a song. it is updated in the same transaction as every rating so the top rated query
+# reads this table (through the index on mean, count and song id) and never has to scan the ratings table
+# rating_1 ... rating_5 is the histogram - how many users gave the song that rating
+class SongRatingStats(db.Model):
+    __table_args__ = (db.Index('ix_song_rating_stats_top', 'rating_mean', 'rating_count', 'song_id'),)
+
+    song_id = db.Column(db.Integer, ForeignKey('songs.id'), primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_mean = db.Column(db.Float, nullable=False, default=0.0)
+    rating_1 = db.Column(db.Integer, nullable=False, default=0)
+    rating_2 = db.Column(db.Integer, nullable=False, default=0)
+    rating_3 = db.Column(db.Integer, nullable=False, default=0)
+    rating_4 = db.Column(db.Integer, nullable=False, default=0)
+    rating_5 = db.Column(db.Integer, nullable=False, default=0)
+
+
+# allowed song ratings - one histogram column in SongRatingStats for each
+rating_values = [1, 2, 3, 4, 5]
+
+# SongRatingStats columns (after song_id) and the aggregates of the ratings table that fill them, in the same order
+song_rating_stats_columns = ['rating_count', 'rating_sum', 'rating_mean'] + \
+                            ['rating_{}'.format(value) for value in rating_values]
+
+
+def song_rating_stats_aggregates():
+    return [func.count(), func.coalesce(func.sum(Ratings.ratings), 0), func.coalesce(func.avg(Ratings.ratings), 0.0)] + \
+           [func.coalesce(func.sum(case([(Ratings.ratings == value, 1)], else_=0)), 0) for value in rating_values]
 
 
 # ============== decorator for header
@@ -132,6 +171,41 @@ def token_required(f):
     return decorated
 
 
+# ============== collection versions for conditional GET (ETag / If-None-Match) ==============
+# clients poll GET /todo, /chat and /emotions a lot and the payload is almost always the same as last time.
+# every (table, user) pair has a version counter in the collection_version table. the write routes bump it in the
+# same transaction as their change, so every gunicorn worker sees the new version as soon as the change is committed.
+# a GET reads the counter (one primary key lookup) and when If-None-Match matches the etag built from it, returns a 304
+# without loading or serializing any rows. If-None-Match uses the weak comparison (RFC 7232), so a W/ tag added by a
+# proxy or gzip layer still matches.
+
+# call this before db.session.commit() whenever rows of a user's collection are added, changed or deleted
+def bump_collection_version(model, user_id):
+    key = {'table_name': model.__tablename__, 'user_id': user_id}
+    # the increment is done by the database, so two writes at the same time can't lose a bump
+    bumped = CollectionVersion.query.filter_by(**key) \
+        .update({'version': CollectionVersion.version + 1}, synchronize_session=False)
+    if not bumped:
+        # first change of this collection - the insert is ignored if another request created the row in the meantime
+        db.session.execute(CollectionVersion.__table__.insert().prefix_with('OR IGNORE').values(version=0, **key))
+        CollectionVersion.query.filter_by(**key) \
+            .update({'version': CollectionVersion.version + 1}, synchronize_session=False)
+
+
+def collection_etag(model, user_id):
+    version = db.session.query(CollectionVersion.version) \
+        .filter_by(table_name=model.__tablename__, user_id=user_id).scalar()
+    marker = '{}:{}:{}'.format(model.__tablename__, user_id, version or 0)
+    return hashlib.sha1(marker.encode('utf-8')).hexdigest()
+
+
+# 304 response for a conditional GET that matched the current etag
+def not_modified_response(etag):
+    response = make_response('', 304)
+    response.set_etag(etag)
+    return response
+
+
 # ============== create database using python shell ==============
 # go to shell and type $ python
 # $ from app import db
@@ -139,6 +213,39 @@ def token_required(f):
 # to create the databases. a file called 'todo.db' will be created in the specified file path
 # exit python shell using # exit()
 
+# ============== migrate song ratings using python shell ==============
+# needed once for a database that has a ratings table from before ratings were unique per user and song
+# (db.create_all() doesn't change existing tables)
+# $ from app import migrate_song_ratings
+# $ migrate_song_ratings()
+# rebuilds the ratings table with an id and the (song_id, user_id) unique constraint, keeping only the latest rating of
+# each user for each song, and recreates song_rating_stats from the ratings. it is safe to run again.
+def migrate_song_ratings():
+    with db.engine.begin() as connection:
+        # pysqlite doesn't start a transaction before DDL statements on its own - start it here so a failing step
+        # rolls the whole migration back
+        connection.execute('BEGIN')
+        if db.engine.dialect.has_table(connection, Ratings.__tablename__):
+            # the old table may have no id column - rowid is there on every sqlite table and grows with each insert
+            connection.execute('ALTER TABLE ratings RENAME TO ratings_legacy')
+            Ratings.__table__.create(connection)
+            connection.execute('INSERT INTO ratings (song_id, user_id, ratings) '
+                               'SELECT song_id, user_id, ratings FROM ratings_legacy '
+                               'WHERE rowid IN (SELECT max(rowid) FROM ratings_legacy GROUP BY song_id, user_id) '
+                               'ORDER BY rowid')
+            connection.execute('DROP TABLE ratings_legacy')
+        else:
+            Ratings.__table__.create(connection)
+
+        SongRatingStats.__table__.drop(connection, checkfirst=True)
+        SongRatingStats.__table__.create(connection)
+        connection.execute(SongRatingStats.__table__.insert().from_select(
+            ['song_id'] + song_rating_stats_columns,
+            select([Ratings.song_id] + song_rating_stats_aggregates()).group_by(Ratings.song_id)))
+
+    print('Migrated song ratings')
+
+
 # ============== check tables using sqlite3 ==============
 # to install sqlite refer to the second answer(by-taimur alam):
 # https://stackoverflow.com/questions/4578231/error-while-accessing-sqlite3-shell-from-django-application
@@ -307,6 +414,11 @@ def login():
 @app.route('/todo', methods=['GET'])
 @token_required
 def get_all_todos(current_user):
+    # nothing changed since the client's last poll - skip the query and the serialization
+    etag = collection_etag(Todo, current_user.id)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified_response(etag)
+
     # query the database to find all to-do's that belong to the current user
     todos = Todo.query.filter_by(user_id=current_user.id).all()
 
@@ -317,7 +429,9 @@ def get_all_todos(current_user):
         todo_data = {'id': todo.id, 'text': todo.text, 'complete': todo.complete}
         output.append(todo_data)
 
-    return jsonify({'todos': output})
+    response = jsonify({'todos': output})
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/todo/<todo_id>', methods=['GET'])
@@ -343,6 +457,7 @@ def create_todo(current_user):
     # we get the user_id from the web token
     new_todo = Todo(text=data['text'], complete=False, user_id=current_user.id)
     db.session.add(new_todo)
+    bump_collection_version(Todo, current_user.id)
     db.session.commit()
     return jsonify({'message': 'Todo Created!'})
 
@@ -357,6 +472,7 @@ def complete_todo(current_user, todo_id):
         return jsonify({'message': 'No todo found!'})
 
     todo.complete = True
+    bump_collection_version(Todo, current_user.id)
     db.session.commit()
     return jsonify({'message': 'Todo item set to complete'})
 
@@ -371,6 +487,7 @@ def delete_todo(current_user, todo_id):
         return jsonify({'message': 'No todo found!'})
 
     db.session.delete(todo)
+    bump_collection_version(Todo, current_user.id)
     # a commit will save the change in the database
     db.session.commit()
     return jsonify({'message': 'Todo item deleted!'})
@@ -414,6 +531,7 @@ def create_chat_conversation(current_user):
     new_conversation = Chat(public_id=str(uuid.uuid4()), user_sentence=client_data['userInput'],
                             chatbot_sentence=chatbot_sentence, user_id=current_user.id, user_emotion=user_emotion)
     db.session.add(new_conversation)
+    bump_collection_version(Chat, current_user.id)
     db.session.commit()
 
     return jsonify(
@@ -429,6 +547,11 @@ def get_all_chat_conversations(current_user):
     if current_user.admin:
         return jsonify({'message': 'Admin users cannot read user chat conversations!'})
 
+    # nothing changed since the client's last poll - skip the query and the serialization
+    etag = collection_etag(Chat, current_user.id)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified_response(etag)
+
     conversations = Chat.query.filter_by(user_id=current_user.id).all()
 
     # an array to hold all the dictionaries
@@ -439,7 +562,10 @@ def get_all_chat_conversations(current_user):
                              'chatbot_sentence': conversation.chatbot_sentence,
                              'user_emotion': conversation.user_emotion}
         output.append(conversation_data)
-    return jsonify({'conversations': output})
+
+    response = jsonify({'conversations': output})
+    response.set_etag(etag)
+    return response
 
 
 # get chats sequential
@@ -494,6 +620,7 @@ def admin_delete_user_chat_conversations(current_user, user_public_id):
     if deleted == 0:
         return jsonify({'message': 'No conversations of user {} deleted!'.format(user_public_id)})
 
+    bump_collection_version(Chat, userId)
     db.session.commit()
     return jsonify({'message': 'chat data of user {} successfully deleted'.format(user_public_id)})
 
@@ -518,6 +645,7 @@ def user_delete_all_chat_conversations(current_user):
     if deleted == 0:
         return jsonify({'message': 'No conversations to delete!'})
 
+    bump_collection_version(Chat, current_user.id)
     db.session.commit()
     return jsonify({'message': 'all conversations successfully deleted'})
 
@@ -530,6 +658,11 @@ def get_all_chat_emotions(current_user):
     if current_user.admin:
         return jsonify({'message': 'Admin users cannot read user chat conversations!'})
 
+    # nothing changed since the client's last poll - skip the query and the serialization
+    etag = collection_etag(Emotion, current_user.id)
+    if request.if_none_match.contains_weak(etag):
+        return not_modified_response(etag)
+
     emotions = Emotion.query.filter_by(user_id=current_user.id).all()
 
     # an array to hold all the dictionaries
@@ -539,7 +672,10 @@ def get_all_chat_emotions(current_user):
         emotion_data = {'id': emotion.id, 'public_id': emotion.public_id, 'user_Input': emotion.user_input,
                         'user_emotion': emotion.user_emotion}
         output.append(emotion_data)
-    return jsonify({'emotions': output})
+
+    response = jsonify({'emotions': output})
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/emotion', methods=['POST'])
@@ -560,11 +696,64 @@ def user_get_emotion(current_user):
     new_emotion = Emotion(public_id=str(uuid.uuid4()), user_input=client_request['userInput'],
                           user_emotion=user_emotion, user_id=current_user.id)
     db.session.add(new_emotion)
+    bump_collection_version(Emotion, current_user.id)
     db.session.commit()
 
     return jsonify({'userInputEmotion': user_emotion}), 200
 
 
+# saves a user's rating of a song and updates the song's aggregate in the same transaction (the caller commits)
+# returns the response message, or None if the user's rating of the song was changed at the same moment.
+# raises IntegrityError if the user's rating of the song was added at the same moment
+def save_song_rating(song_id, user_id, new_value):
+    # a song that has no aggregate row yet (never rated since migrate_song_ratings) gets one seeded from the ratings
+    # it already has. the primary key lookup keeps the scan of the song's ratings off the path of every other rating
+    if not SongRatingStats.query.get(song_id):
+        # ignored if another request seeded the row in the meantime
+        db.session.execute(SongRatingStats.__table__.insert().prefix_with('OR IGNORE').from_select(
+            ['song_id'] + song_rating_stats_columns,
+            select([literal(song_id)] + song_rating_stats_aggregates()).where(Ratings.song_id == song_id)))
+
+    rating = Ratings.query.filter_by(song_id=song_id, user_id=user_id).first()
+    if rating:
+        old_value = rating.ratings
+        if old_value == new_value:
+            return 'Rating updated'
+
+        # the user already rated this song - move the old rating out of the aggregate.
+        # the update only matches if the rating is still the one that was read, otherwise the aggregate would be
+        # moved by the wrong amount
+        changed = Ratings.query.filter_by(id=rating.id, ratings=old_value) \
+            .update({'ratings': new_value}, synchronize_session=False)
+        if not changed:
+            return None
+        count_change = 0
+        sum_change = new_value - old_value
+        changes = {}
+        # ratings from before the allowed values were checked have no histogram column
+        if old_value in rating_values:
+            old_column = 'rating_{}'.format(old_value)
+            changes[old_column] = getattr(SongRatingStats, old_column) - 1
+        message = 'Rating updated'
+    else:
+        db.session.add(Ratings(song_id=song_id, user_id=user_id, ratings=new_value))
+        db.session.flush()
+        count_change = 1
+        sum_change = new_value
+        changes = {}
+        message = 'Rating added'
+
+    # every value is computed by the database from the current row, so concurrent ratings can't lose an update
+    new_column = 'rating_{}'.format(new_value)
+    changes[new_column] = getattr(SongRatingStats, new_column) + 1
+    changes['rating_count'] = SongRatingStats.rating_count + count_change
+    changes['rating_sum'] = SongRatingStats.rating_sum + sum_change
+    changes['rating_mean'] = cast(SongRatingStats.rating_sum + sum_change, db.Float) / \
+        (SongRatingStats.rating_count + count_change)
+    SongRatingStats.query.filter_by(song_id=song_id).update(changes, synchronize_session=False)
+    return message
+
+
 @app.route('/rating', methods=['POST'])
 @token_required
 def user_create_song_rating(current_user):
@@ -573,11 +762,57 @@ def user_create_song_rating(current_user):
         return jsonify({'message': 'This delete route is not for Admin users user route /chat/[user_id]'})
 
     data = request.get_json()
+    song_id = data['song_id']
+    new_value = data['rating']
 
-    new_rating = Ratings(song_id=data['song_id'], user_id=current_user.id, ratings=data['rating'])
-    db.session.add(new_rating)
-    db.session.commit()
-    return jsonify({'message': 'Rating added'})
+    # bool is an int and 5.0 == 5, so check the type as well
+    if type(new_value) is not int or new_value not in rating_values:
+        return jsonify({'message': 'Rating must be one of {}'.format(rating_values)}), 400
+
+    if not Songs.query.get(song_id):
+        return jsonify({'message': 'No song found!'}), 404
+
+    # another rating of the same user and song saved at the same moment (double submit) makes the save fail.
+    # the next attempt sees that rating and updates it
+    for attempt in range(3):
+        try:
+            message = save_song_rating(song_id, current_user.id, new_value)
+        except IntegrityError:
+            message = None
+        if message:
+            db.session.commit()
+            return jsonify({'message': message})
+        db.session.rollback()
+
+    return jsonify({'message': 'Rating could not be saved, please try again'}), 409
+
+
+# top rated songs, read straight from the aggregate table
+# query parameters: page (starts at 1) and per_page (max 50)
+# example: /rating/top?page=2&per_page=10
+@app.route('/rating/top', methods=['GET'])
+@token_required
+def get_top_rated_songs(current_user):
+    page = request.args.get('page', 1, type=int)
+    per_page = request.args.get('per_page', 10, type=int)
+    if page < 1 or per_page < 1 or per_page > 50:
+        return jsonify({'message': 'page must be 1 or more and per_page between 1 and 50'}), 400
+
+    top_songs = db.session.query(SongRatingStats, Songs) \
+        .join(Songs, Songs.id == SongRatingStats.song_id) \
+        .order_by(SongRatingStats.rating_mean.desc(), SongRatingStats.rating_count.desc(),
+                  SongRatingStats.song_id.desc()) \
+        .limit(per_page).offset((page - 1) * per_page)
+
+    # an array to hold selected page size
+    output = []
+    for stats, song in top_songs:
+        song_data = {'song_id': song.id, 'song_name': song.song_name, 'song_link': song.song_link,
+                     'rating_count': stats.rating_count, 'rating_mean': stats.rating_mean,
+                     'histogram': {str(value): getattr(stats, 'rating_{}'.format(value)) for value in rating_values}}
+        output.append(song_data)
+
+    return jsonify({'songs': output, 'page': page, 'per_page': per_page})
 
 
 @app.route('/emotions', methods=['DELETE'])
@@ -600,6 +835,7 @@ def user_delete_all_emotions(current_user):
     if deleted == 0:
         return jsonify({'message': 'No emotions to delete!'})
 
+    bump_collection_version(Emotion, current_user.id)
     db.session.commit()
     return jsonify({'message': 'all emotions were successfully deleted'})
 
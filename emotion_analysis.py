@@ -30,26 +30,37 @@ readEmotionDataSets()
 getEmotionModel()
 
 
-def preProcessEmotionModel(encodedJson):
-    max_seq_len = 500
+# padding length of the model input
+max_seq_len = 500
+
+# class Name on Emotions - the model's output index maps to this list
+class_names = ['joy', 'fear', 'anger', 'sadness', 'neutral']
 
-    data = data_train.append(data_test, ignore_index=True)
 
-    # defining a function to clean data
-    def clean_text(data):
-        # remove hashtags and @usernames
-        data = re.sub(r"(#[\d\w\.]+)", '', data)
-        data = re.sub(r"(@[\d\w\.]+)", '', data)
+# defining a function to clean data
+def clean_text(data):
+    # remove hashtags and @usernames
+    data = re.sub(r"(#[\d\w\.]+)", '', data)
+    data = re.sub(r"(@[\d\w\.]+)", '', data)
 
-        # tokenization using nltk
-        data = word_tokenize(data)
-        return data
+    # tokenization using nltk
+    data = word_tokenize(data)
+    return data
+
+
+# Tokenizing and fitting the tokenizer on the cleaned datasets using keras library
+def fitEmotionTokenizer():
+    data = data_train.append(data_test, ignore_index=True)
 
     texts = [' '.join(clean_text(text)) for text in data.Text]
 
-    # Tokenizing and fitting the model using keras library
     tokenizer = Tokenizer()
     tokenizer.fit_on_texts(texts)
+    return tokenizer
+
+
+def preProcessEmotionModel(encodedJson):
+    tokenizer = fitEmotionTokenizer()
 
     def prediction():
         # Preprocessing the text
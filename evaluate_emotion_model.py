@@ -0,0 +1,204 @@
+# Accuracy and throughput evaluation of the emotion model (ml_models/bi_gru_w2vec_v2_30eps.h5)
+# run this before changing anything about how the model is served (padding length, preprocessing, batching, runtime)
+# and only switch to a faster inference path if it doesn't lose accuracy or agreement with the reference path.
+#
+# usage (from the project directory, same virtualenv as the app):
+# $ python evaluate_emotion_model.py
+# $ python evaluate_emotion_model.py --batch-sizes 1 16 64 --paths keras_reference keras_cached_tokenizer
+# $ python evaluate_emotion_model.py --max-rows 500 --output results.csv
+#
+# for every dataset and every inference path it reports:
+# accuracy and macro-F1 against the gold 'Emotion' labels, the label agreement rate with the reference keras path
+# (the preProcessEmotionModel function the app uses) and rows per second at each batch size.
+# macro-F1 averages over the emotions the dataset has - they are listed in the f1_classes column.
+# rows whose text is also in data/data_train.csv are left out, so the figures aren't inflated by training data.
+# the comparison table is printed and written to --output as csv.
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import accuracy_score, f1_score
+from keras.preprocessing.sequence import pad_sequences
+
+# importing emotion_analysis loads the model and the datasets exactly like the app does
+import emotion_analysis
+from emotion_analysis import class_names
+
+# the extra corpora use other names for some of the model's emotions.
+# rows with emotions the model doesn't know (surprise, shame, disgust, guilt) are left out of the evaluation
+label_aliases = {'happy': 'joy', 'sad': 'sadness'}
+
+datasets = {
+    'data_test': 'data/data_test.csv',
+    'emotion-stimulus': 'data/datasets/emotion-stimulus.csv',
+    'isear': 'data/datasets/isear.csv',
+}
+
+
+# texts the model was trained on
+train_texts = set(emotion_analysis.data_train.Text.astype(str).str.strip())
+
+
+def read_dataset(path, max_rows=None):
+    data = pd.read_csv(path, encoding='utf-8')
+    labels = data.Emotion.str.strip().str.lower().replace(label_aliases)
+    known = labels.isin(class_names)
+    data = pd.DataFrame({'Text': data.Text[known].astype(str), 'Emotion': labels[known]}).reset_index(drop=True)
+    skipped = int((~known).sum())
+    # many rows of the corpora are in the training data verbatim - they would only measure memorization
+    in_train = data.Text.str.strip().isin(train_texts)
+    data = data[~in_train].reset_index(drop=True)
+    overlap = int(in_train.sum())
+    if max_rows:
+        data = data.head(max_rows)
+    return data, skipped, overlap
+
+
+# ============== inference paths ==============
+# every path is built once and returns a function that takes a list of texts and returns the class probabilities
+
+def build_keras_reference():
+    # the served code, unchanged - it fits a new tokenizer on every call
+    def predict(texts):
+        return emotion_analysis.preProcessEmotionModel(texts)
+
+    return predict
+
+
+# same preprocessing and model as the served code, but the tokenizer is fitted only once
+def build_keras_cached_tokenizer():
+    tokenizer = emotion_analysis.fitEmotionTokenizer()
+
+    def predict(texts):
+        padded = pad_sequences(tokenizer.texts_to_sequences(texts), maxlen=emotion_analysis.max_seq_len)
+        return emotion_analysis.loaded_model_v2.predict(padded, batch_size=len(texts))
+
+    return predict
+
+
+def build_tflite():
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(emotion_analysis.loaded_model_v2)
+    # the GRU layers need a few ops that aren't tflite builtins
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    interpreter = tf.lite.Interpreter(model_content=converter.convert())
+    input_details = interpreter.get_input_details()[0]
+    output_index = interpreter.get_output_details()[0]['index']
+    tokenizer = emotion_analysis.fitEmotionTokenizer()
+    max_seq_len = emotion_analysis.max_seq_len
+    allocated = {'batch_size': None}
+
+    def predict(texts):
+        padded = pad_sequences(tokenizer.texts_to_sequences(texts), maxlen=max_seq_len)
+        # the interpreter only has to be resized when the batch size changes
+        if allocated['batch_size'] != len(texts):
+            interpreter.resize_tensor_input(input_details['index'], [len(texts), max_seq_len])
+            interpreter.allocate_tensors()
+            allocated['batch_size'] = len(texts)
+        interpreter.set_tensor(input_details['index'], padded.astype(input_details['dtype']))
+        interpreter.invoke()
+        return interpreter.get_tensor(output_index)
+
+    return predict
+
+
+# the first path is the reference the others are compared against
+inference_paths = {
+    'keras_reference': build_keras_reference,
+    'keras_cached_tokenizer': build_keras_cached_tokenizer,
+    'tflite': build_tflite,
+}
+
+
+# ============== evaluation ==============
+
+def predict_labels(predict, texts, batch_size):
+    indices = []
+    for start in range(0, len(texts), batch_size):
+        probabilities = predict(texts[start:start + batch_size])
+        indices.extend(np.argmax(probabilities, axis=1))
+    return [class_names[index] for index in indices]
+
+
+def rows_per_second(predict, texts, batch_size):
+    # warm up once so graph building and tensor allocation aren't timed
+    predict(texts[:batch_size])
+    start = time.perf_counter()
+    for offset in range(0, len(texts), batch_size):
+        predict(texts[offset:offset + batch_size])
+    return len(texts) / (time.perf_counter() - start)
+
+
+def evaluate(path_names, batch_sizes, max_rows, throughput_rows):
+    predictors = {}
+    errors = {}
+    for name in path_names:
+        try:
+            predictors[name] = inference_paths[name]()
+        except Exception as error:
+            errors[name] = '{}: {}'.format(type(error).__name__, error)
+
+    reference_name = path_names[0]
+    # predictions are made with the largest batch size, the batch size shouldn't change the answer
+    eval_batch_size = max(batch_sizes)
+    results = []
+
+    for dataset_name, dataset_path in datasets.items():
+        data, skipped, overlap = read_dataset(dataset_path, max_rows)
+        texts = list(data.Text)
+        gold = list(data.Emotion)
+        # the extra corpora have no neutral rows - averaging over a class that isn't there would always add a 0
+        f1_classes = sorted(set(gold))
+        print('{}: {} rows ({} rows with other emotions and {} rows also in the training data skipped)'.format(
+            dataset_name, len(texts), skipped, overlap))
+
+        reference_labels = None
+        for name in path_names:
+            row = {'dataset': dataset_name, 'path': name, 'rows': len(texts), 'train_overlap_skipped': overlap,
+                   'f1_classes': ' '.join(f1_classes)}
+            if name not in predictors:
+                row['error'] = errors[name]
+                results.append(row)
+                continue
+
+            try:
+                labels = predict_labels(predictors[name], texts, eval_batch_size)
+                row['accuracy'] = accuracy_score(gold, labels)
+                row['macro_f1'] = f1_score(gold, labels, labels=f1_classes, average='macro', zero_division=0)
+                if name == reference_name:
+                    reference_labels = labels
+                if reference_labels is not None:
+                    row['agreement'] = float(np.mean([a == b for a, b in zip(labels, reference_labels)]))
+
+                for batch_size in batch_sizes:
+                    row['rows_per_sec_bs{}'.format(batch_size)] = rows_per_second(
+                        predictors[name], texts[:throughput_rows], batch_size)
+            except Exception as error:
+                row['error'] = '{}: {}'.format(type(error).__name__, error)
+            results.append(row)
+
+    return pd.DataFrame(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare accuracy and throughput of the emotion model inference paths')
+    parser.add_argument('--paths', nargs='+', default=list(inference_paths), choices=list(inference_paths),
+                        help='inference paths to run, the first one is the reference for the agreement rate')
+    parser.add_argument('--batch-sizes', nargs='+', type=int, default=[1, 8, 32, 128])
+    parser.add_argument('--max-rows', type=int, default=None, help='only evaluate the first rows of each dataset')
+    parser.add_argument('--throughput-rows', type=int, default=128,
+                        help='rows used to time each batch size (the reference path refits its tokenizer per call)')
+    parser.add_argument('--output', default='model_evaluation.csv')
+    args = parser.parse_args()
+
+    results = evaluate(args.paths, args.batch_sizes, args.max_rows, args.throughput_rows)
+    pd.set_option('display.width', 200)
+    print(results.to_string(index=False, float_format='{:.4f}'.format))
+    results.to_csv(args.output, index=False)
+    print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()